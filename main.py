@@ -4,15 +4,15 @@ import streamlit as st
 import google.generativeai as genai
 import requests
 import json
-from PIL import Image
-import io
+import orjson
 import os
+import re
 from dotenv import load_dotenv
 import streamlit.components.v1 as components
-import base64
-
-# Load environment variables at the very beginning of the script.
-load_dotenv()
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.scriptrunner_utils.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
 
 
 # --- 1. Configuration and Setup ---
@@ -31,17 +31,83 @@ def load_api_keys():
     return google_api_key, stability_api_key
 
 
-GOOGLE_API_KEY, STABILITY_API_KEY = load_api_keys()
+@st.cache_resource
+def bootstrap():
+    """Loads the .env file, reads the API keys and configures Gemini once per process."""
+    load_dotenv()
+    google_api_key, stability_api_key = load_api_keys()
+    if google_api_key:
+        genai.configure(api_key=google_api_key)
+    return google_api_key, stability_api_key
+
 
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-else:
+GOOGLE_API_KEY, STABILITY_API_KEY = bootstrap()
+
+if not GOOGLE_API_KEY:
+    # Don't keep the missing-key result cached, so a fixed .env or secrets file is picked up on the next rerun.
+    bootstrap.clear()
     st.error("Google API Key not found. Please set it in your secrets or .env file.")
     st.stop()
 
 
+@st.cache_resource
+def get_gemini_model(name='gemini-1.5-flash-latest'):
+    """Builds the Gemini model handle once per process and reuses it across reruns."""
+    return genai.GenerativeModel(name)
+
+
+@st.cache_resource
+def get_story_generation_config():
+    """Builds the chapter sampling settings once per process instead of once per chapter."""
+    return genai.types.GenerationConfig(temperature=0.9)
+
+
+@st.cache_resource
+def get_thread_sessions():
+    """Per-thread storage for HTTP sessions, shared across reruns."""
+    return threading.local()
+
+
+def get_http_session():
+    """Returns this thread's pooled HTTP session so Stability calls reuse the open TLS connection."""
+    # requests.Session is not thread-safe, so each worker thread keeps its own.
+    sessions = get_thread_sessions()
+    if not hasattr(sessions, "session"):
+        sessions.session = requests.Session()
+        sessions.session.headers.update({"Accept": "image/*"})
+    return sessions.session
+
+
+@st.cache_resource
+def get_executor():
+    """Shared worker pool for network calls that can overlap with rendering."""
+    return ThreadPoolExecutor(max_workers=8)
+
+
+def run_in_background(fn, *args):
+    """Submits fn to the worker pool with the current script context attached, so Streamlit caches keep working."""
+    ctx = get_script_run_ctx()
+
+    def task():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        try:
+            return fn(*args)
+        finally:
+            # Pool threads are shared by every session; don't leave this one holding our context.
+            delattr(threading.current_thread(), SCRIPT_RUN_CONTEXT_ATTR_NAME)
+
+    return get_executor().submit(task)
+
+
 # --- 2. AI and Helper Functions ---
 
+# The last RECENT_CHAPTERS chapters are always sent verbatim; older ones are folded
+# into a rolling summary SUMMARY_BATCH chapters at a time.
+RECENT_CHAPTERS = 3
+SUMMARY_BATCH = 3
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
 def generate_world_bible(theme, archetype, contradiction):
     """Generates the story's core rules and tone using Gemini."""
     prompt = f"""
@@ -53,87 +119,209 @@ def generate_world_bible(theme, archetype, contradiction):
 
     Generate the World Bible based on these inputs.
     """
-    with st.spinner("Generating the core of your universe..."):
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        response = model.generate_content(prompt)
-        return response.text
+    model = get_gemini_model()
+    response = model.generate_content(prompt)
+    return response.text
+
+
+# Matches a leading ```json / ``` fence and a trailing ``` fence around a model's JSON reply.
+_JSON_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+# Matches the "narrative_chapter" value of a JSON object that may still be streaming in.
+_PARTIAL_NARRATIVE = re.compile(r'"narrative_chapter"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+
+def extract_partial_narrative(raw_text):
+    """Returns as much of the narrative chapter as has arrived so far, or an empty string."""
+    match = _PARTIAL_NARRATIVE.search(raw_text)
+    if not match:
+        return ""
+    try:
+        return json.loads(f'"{match.group(1)}"', strict=False)
+    except json.JSONDecodeError:
+        # A half-received escape sequence; the next chunk will complete it.
+        return ""
 
 
 def generate_story_chapter(story_context, world_bible, user_choice):
     """Generates the next narrative chapter, choices, and image prompt."""
-    model = genai.GenerativeModel('gemini-1.5-flash-latest')
-    generation_config = genai.types.GenerationConfig(temperature=0.9)
+    model = get_gemini_model()
     # CORRECTED PROMPT: Explicitly asks for a valid JSON array of strings for choices.
+    # The instructions and World Bible stay identical for a whole saga, so they lead the prompt
+    # where Gemini's prefix caching can reuse them; only the tail changes from chapter to chapter.
     prompt = f"""
     You are a multi-persona Storytelling Engine. Follow these steps precisely.
-    The user's choice for the last chapter was: "{user_choice}".
-    The full story context so far is: "{story_context}".
-    The secret World Bible for this universe is: "{world_bible}".
 
     Step 1: Act as a Literary Artist. Write a rich, descriptive paragraph expanding on the user's choice.
     Step 2: Act as a Plot Theorist. Based on the new paragraph, generate three distinct, single-sentence plot choices for the user. One must be a 'Wildcard'. Format these choices as a simple JSON array of strings.
     Step 3: Act as an Art Director. Based on the paragraph from Step 1, write a concise, descriptive prompt for an AI image generator (comma-separated keywords).
     Step 4: Format your entire response as a single, raw JSON object with NO markdown formatting, using these exact keys: "narrative_chapter", "next_choices", and "image_prompt".
+
+    The secret World Bible for this universe is: "{world_bible}".
+
+    ----------
+    The full story context so far is: "{story_context}".
+    The user's choice for the last chapter was: "{user_choice}".
     """
+    narrative_slot = st.empty()
+    raw_text = ""
     with st.spinner("The Storyteller is weaving the next chapter..."):
         try:
-            response = model.generate_content(prompt, generation_config=generation_config)
-            cleaned_json_string = response.text.strip().replace("```json", "").replace("```", "").strip()
-            data = json.loads(cleaned_json_string)
+            # Stream the response so the chapter appears while the rest of the JSON is still being written.
+            response = model.generate_content(prompt, generation_config=get_story_generation_config(), stream=True)
+            for chunk in response:
+                raw_text += chunk.text
+                narrative = extract_partial_narrative(raw_text)
+                if narrative:
+                    narrative_slot.markdown(f"*{narrative}*")
+            cleaned_json_string = _JSON_FENCE.sub("", raw_text.strip())
+            data = orjson.loads(cleaned_json_string)
+            narrative_slot.markdown(f"*{data['narrative_chapter']}*")
             return data
         except Exception as e:
+            narrative_slot.empty()
             st.error(f"Error processing AI response: {e}. The AI may have returned an unexpected format.")
-            st.code(response.text)
+            st.code(raw_text)
             return None
 
 
+def summarize_story(previous_summary, chapters):
+    """Folds older chapters into the running story summary using Gemini. Runs on a worker thread."""
+    prompt = f"""
+    You are a story editor. Condense the story below into a single summary of at most 200 words.
+    Keep every named character, unresolved conflict, and promise the story has made to the reader.
+
+    Summary of the story so far: "{previous_summary}"
+    Chapters that follow it: "{" ".join(chapters)}"
+    """
+    model = get_gemini_model()
+    response = model.generate_content(prompt)
+    return response.text.strip()
+
+
+def add_chapter(text, image_bytes=None):
+    """Appends a chapter to the saga and keeps the running full-story text in step."""
+    st.session_state.chapter_texts.append(text)
+    st.session_state.chapter_images.append(image_bytes)
+    if st.session_state.full_story_text:
+        st.session_state.full_story_text += " " + text
+    else:
+        st.session_state.full_story_text = text
+
+
+def update_rolling_summary():
+    """Applies a finished background summary and starts the next one once enough chapters pile up."""
+    summary_future = st.session_state.summary_future
+    if summary_future is not None and summary_future.done():
+        try:
+            st.session_state.rolling_summary = summary_future.result()
+            st.session_state.summarized_count = st.session_state.summary_target
+        except Exception:
+            # Keep sending those chapters verbatim; they are retried with the next batch.
+            pass
+        st.session_state.summary_future = None
+
+    chapter_count = len(st.session_state.chapter_texts)
+    unsummarized = chapter_count - st.session_state.summarized_count
+    if st.session_state.summary_future is None and unsummarized >= RECENT_CHAPTERS + SUMMARY_BATCH:
+        st.session_state.summary_target = chapter_count - RECENT_CHAPTERS
+        st.session_state.summary_future = run_in_background(
+            summarize_story,
+            st.session_state.rolling_summary,
+            st.session_state.chapter_texts[st.session_state.summarized_count:st.session_state.summary_target],
+        )
+
+
+def build_story_context():
+    """Returns the rolling summary followed by the chapters it does not cover yet, keeping the prompt size bounded."""
+    update_rolling_summary()
+    recent_chapters = " ".join(st.session_state.chapter_texts[st.session_state.summarized_count:])
+    if not st.session_state.rolling_summary:
+        return recent_chapters
+    return f"{st.session_state.rolling_summary}\n\nRecent chapters:\n{recent_chapters}"
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
 def generate_image_stability(prompt):
-    """Generates an image using the Stability.ai API with robust error handling."""
+    """Generates image bytes using the Stability.ai API. Runs on a worker thread, so errors are raised, not rendered."""
+    # The v2beta endpoint can return raw JPEG bytes, much smaller than v1's base64-encoded PNG.
+    API_URL = "https://api.stability.ai/v2beta/stable-image/generate/core"
+
+    headers = {"Authorization": f"Bearer {STABILITY_API_KEY}"}
+    payload = {
+        "prompt": f"cinematic, epic, high detail, masterpiece, {prompt}",
+        "aspect_ratio": "1:1",
+        "output_format": "jpeg",
+    }
+
+    # The endpoint only accepts multipart/form-data, hence the empty file part.
+    response = get_http_session().post(API_URL, headers=headers, files={"none": ""}, data=payload, timeout=60)
+    response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
+    return response.content
+
+
+def start_image_generation(prompt):
+    """Starts painting the scene in the background and returns a future, or None if image generation is disabled."""
     if not STABILITY_API_KEY:
         st.warning("Stability API Key not found. Image generation is disabled.")
         return None
+    return run_in_background(generate_image_stability, prompt)
 
-    # CORRECTED MODEL ID: Using a valid, current model.
-    engine_id = "stable-diffusion-xl-1024-v1-0"
-    API_URL = f"https://api.stability.ai/v1/generation/{engine_id}/text-to-image"
 
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {STABILITY_API_KEY}",
+def prefetch_choice_images(choices, scene_prompt):
+    """Starts painting the current scene for every offered choice, so the picked one is ready (or nearly) on click."""
+    if not STABILITY_API_KEY:
+        st.session_state.prefetched_images = {}
+        return
+    st.session_state.prefetched_images = {
+        choice: run_in_background(generate_image_stability, f"{scene_prompt}, {choice}") for choice in choices
     }
-    payload = {
-        "text_prompts": [{"text": f"cinematic, epic, high detail, masterpiece, {prompt}"}],
-        "cfg_scale": 7,
-        "height": 1024,
-        "width": 1024,
-        "samples": 1,
-        "steps": 30,
+
+
+def cancel_prefetched_images(keep_choice=None):
+    """Cancels the prefetched scenes for every choice but keep_choice, so they stop holding the shared worker pool."""
+    for choice, image_future in st.session_state.prefetched_images.items():
+        if choice != keep_choice:
+            image_future.cancel()
+    st.session_state.prefetched_images = {
+        choice: image_future
+        for choice, image_future in st.session_state.prefetched_images.items()
+        if choice == keep_choice
     }
 
+
+def collect_prefetched_image(image_future, fallback_prompt):
+    """Waits for a prefetched scene, painting fallback_prompt instead if there is none or it failed."""
+    if image_future is not None:
+        with st.spinner("The Stability artist is painting the scene..."):
+            try:
+                return image_future.result()
+            except Exception:
+                # Errors from the fallback attempt below are the ones worth reporting.
+                pass
+    return collect_image(start_image_generation(fallback_prompt))
+
+
+def collect_image(image_future):
+    """Waits for a background image with robust error handling."""
+    if image_future is None:
+        return None
+
     with st.spinner("The Stability artist is painting the scene..."):
         try:
-            response = requests.post(API_URL, headers=headers, json=payload)
-            response.raise_for_status() # Raise an exception for bad status codes (4xx or 5xx)
-
-            data = response.json()
-            image_b64 = data["artifacts"][0]["base64"]
-            return Image.open(io.BytesIO(base64.b64decode(image_b64)))
+            return image_future.result()
 
         except requests.exceptions.HTTPError as e:
             st.error(f"HTTP Error from Stability API: {e.response.status_code}")
             try:
                 # Show the detailed error message from the API
-                error_details = e.response.json()
+                error_details = orjson.loads(e.response.content)
                 st.error("API Response:")
                 st.json(error_details)
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 st.error("Raw API Response Text:")
                 st.code(e.response.text)
             return None
-        except (KeyError, IndexError) as e:
-            st.error(f"Error parsing Stability API response. The expected data structure was not found. Error: {e}")
-            return None
         except Exception as e:
             st.error(f"An unexpected error occurred with the Stability API: {e}")
             return None
@@ -141,12 +329,13 @@ def generate_image_stability(prompt):
 
 def text_to_speech_player(text):
     """Generates a silent autoplaying HTML5 audio player for narration."""
-    safe_text = text.replace("'", "\\'").replace('"', '\\"').replace("\n", " ").strip()
+    # json.dumps yields a valid JS string literal; escaping "</" keeps the text from closing the script tag.
+    js_text = json.dumps(text.replace("\n", " ").strip()).replace("</", "<\\/")
     components.html(f"""
         <script>
             const synth = window.speechSynthesis;
             if (synth.speaking) {{ synth.cancel(); }}
-            const utterance = new SpeechSynthesisUtterance("{safe_text}");
+            const utterance = new SpeechSynthesisUtterance({js_text});
             utterance.pitch = 1;
             utterance.rate = 0.9;
             synth.speak(utterance);
@@ -154,6 +343,24 @@ def text_to_speech_player(text):
     """, height=0)
 
 
+def render_saga():
+    """Renders every chapter so far."""
+    for text, image_bytes in zip(st.session_state.chapter_texts, st.session_state.chapter_images):
+        if image_bytes:
+            st.image(image_bytes, output_format="JPEG", width="stretch")
+        st.markdown(f"*{text}*")
+        st.markdown("---")
+
+
+@st.fragment
+def audio_controls(text):
+    """Narration buttons; clicking them reruns only this fragment, not the whole story cycle."""
+    col1, col2, col3 = st.columns([2, 1, 1])
+    if col1.button("🔊 Narrate Story"): text_to_speech_player(text)
+    if col2.button("⏸ Pause"): components.html("<script>window.speechSynthesis.pause();</script>", height=0)
+    if col3.button("⏹ Stop"): components.html("<script>window.speechSynthesis.cancel();</script>", height=0)
+
+
 # --- 3. Streamlit Application UI and Logic ---
 
 st.title("The Multimodal Storyteller 🪶")
@@ -165,8 +372,15 @@ st.markdown(
 if 'app_stage' not in st.session_state:
     st.session_state.app_stage = "world_forge"
     st.session_state.world_bible = None
-    st.session_state.story_chapters = []
+    st.session_state.chapter_texts = []
+    st.session_state.chapter_images = []
+    st.session_state.full_story_text = ""
     st.session_state.latest_choices = []
+    st.session_state.prefetched_images = {}
+    st.session_state.rolling_summary = ""
+    st.session_state.summarized_count = 0
+    st.session_state.summary_target = 0
+    st.session_state.summary_future = None
 
 if st.session_state.app_stage == "world_forge":
     with st.form("world_forge_form"):
@@ -178,7 +392,8 @@ if st.session_state.app_stage == "world_forge":
                                       "A city of high magic where everyone is profoundly bored.")
 
         if st.form_submit_button("Set the Stage"):
-            st.session_state.world_bible = generate_world_bible(theme, archetype, contradiction)
+            with st.spinner("Generating the core of your universe..."):
+                st.session_state.world_bible = generate_world_bible(theme, archetype, contradiction)
             st.session_state.app_stage = "story_start"
             st.rerun()
 
@@ -190,31 +405,26 @@ elif st.session_state.app_stage == "story_start":
         initial_prompt = st.text_area("Your opening sentence:",
                                       "The last starship captain woke from cryo-sleep to the sound of a ticking clock.")
         if st.form_submit_button("Start the Saga") and initial_prompt:
-            st.session_state.story_chapters.append({"text": initial_prompt, "image": None})
+            add_chapter(initial_prompt)
             ai_response = generate_story_chapter("", st.session_state.world_bible, initial_prompt)
             
             if ai_response:
-                new_image = generate_image_stability(ai_response["image_prompt"])
-                st.session_state.story_chapters[0]["image"] = new_image
-                st.session_state.story_chapters.append({"text": ai_response["narrative_chapter"], "image": None})
+                # The new chapter is already on screen; paint its scene in the background.
+                image_future = start_image_generation(ai_response["image_prompt"])
+                st.session_state.chapter_images[0] = collect_image(image_future)
+                add_chapter(ai_response["narrative_chapter"])
+                update_rolling_summary()
                 st.session_state.latest_choices = ai_response["next_choices"]
+                prefetch_choice_images(st.session_state.latest_choices, ai_response["image_prompt"])
                 st.session_state.app_stage = "story_cycle"
                 st.rerun()
 
 elif st.session_state.app_stage == "story_cycle":
     st.header("Your Saga Unfolds...")
-    for chapter in st.session_state.story_chapters:
-        if chapter["image"]:
-            st.image(chapter["image"], use_column_width=True)
-        st.markdown(f"*{chapter['text']}*")
-        st.markdown("---")
+    render_saga()
 
-    if st.session_state.story_chapters:
-        full_story_text = " ".join([ch['text'] for ch in st.session_state.story_chapters])
-        col1, col2, col3 = st.columns([2, 1, 1])
-        if col1.button("🔊 Narrate Story"): text_to_speech_player(full_story_text)
-        if col2.button("⏸ Pause"): components.html("<script>window.speechSynthesis.pause();</script>", height=0)
-        if col3.button("⏹ Stop"): components.html("<script>window.speechSynthesis.cancel();</script>", height=0)
+    if st.session_state.full_story_text:
+        audio_controls(st.session_state.full_story_text)
 
     st.header("What Happens Next?")
 
@@ -222,21 +432,30 @@ elif st.session_state.app_stage == "story_cycle":
         with st.form("choice_form"):
             choice_made = st.radio("Choose a path:", st.session_state.latest_choices, key="choice_radio")
             if st.form_submit_button("Weave Next Chapter"):
-                story_so_far = " ".join([ch['text'] for ch in st.session_state.story_chapters])
+                cancel_prefetched_images(keep_choice=choice_made)
+                story_so_far = build_story_context()
                 ai_response = generate_story_chapter(story_so_far, st.session_state.world_bible, choice_made)
 
                 if ai_response:
-                    new_image = generate_image_stability(ai_response["image_prompt"])
-                    st.session_state.story_chapters.append(
-                        {"text": ai_response["narrative_chapter"], "image": new_image})
+                    # The scene was prefetched from the previous chapter's image prompt plus this choice,
+                    # so it trails the chapter just written; this chapter's own prompt is the fallback.
+                    new_image = collect_prefetched_image(
+                        st.session_state.prefetched_images.get(choice_made), ai_response["image_prompt"])
+                    add_chapter(ai_response["narrative_chapter"], new_image)
+                    update_rolling_summary()
                     st.session_state.latest_choices = ai_response["next_choices"]
+                    prefetch_choice_images(st.session_state.latest_choices, ai_response["image_prompt"])
                     st.rerun()
 
 # Add a restart button to the sidebar for easy access
 st.sidebar.markdown("---")
 st.sidebar.header("Controls")
 if st.sidebar.button("Start a New Saga (Restart)"):
-    keys_to_clear = ['app_stage', 'world_bible', 'story_chapters', 'latest_choices']
+    if 'prefetched_images' in st.session_state:
+        cancel_prefetched_images()
+    keys_to_clear = ['app_stage', 'world_bible', 'chapter_texts', 'chapter_images', 'full_story_text',
+                     'latest_choices', 'prefetched_images', 'rolling_summary', 'summarized_count',
+                     'summary_target', 'summary_future']
     for key in keys_to_clear:
         if key in st.session_state:
             del st.session_state[key]